@@ -112,7 +112,7 @@ if [ -f "requirements.txt" ]; then
   pip install -r requirements.txt
 else
   # Pin Flask + Werkzeug to compatible versions
-  pip install "flask==2.2.5" "werkzeug==2.2.3" gunicorn psutil requests
+  pip install "flask==2.2.5" "werkzeug==2.2.3" gunicorn gevent psutil requests
 fi
 deactivate
 
@@ -220,7 +220,7 @@ After=network.target
 User=$USERNAME
 WorkingDirectory=$HOME_DIR/nbt
 Environment="DB_PATH=/etc/x-ui/x-ui.db"
-ExecStart=/bin/bash -lc 'source $HOME_DIR/nbt/venv/bin/activate && exec gunicorn -w 4 -b 0.0.0.0:$PORT $SSL_CONTEXT app:app'
+ExecStart=/bin/bash -lc 'source $HOME_DIR/nbt/venv/bin/activate && exec gunicorn -k gevent -w 2 --worker-connections 1000 -b 0.0.0.0:$PORT $SSL_CONTEXT app:app'
 Restart=always
 RestartSec=5
 StandardOutput=append:/var/log/nbt.log
@@ -1,46 +1,158 @@
 #!/usr/bin/env python3
 # Traffic-X: Flask app
-# Compatible with systemd ExecStart: gunicorn -w 4 -b 0.0.0.0:$PORT app:app
+# Compatible with systemd ExecStart: gunicorn -k gevent -w 2 --worker-connections 1000 -b 0.0.0.0:$PORT app:app
 
 from __future__ import annotations
-from flask import Flask, request, render_template, jsonify
 import os
+
+# Patch before anything imports socket/ssl/threading (flask, requests).
+# gunicorn's gevent worker patches too; this covers `python app.py`.
+# GEVENT_PATCH=0 skips only this module's patch_all() (e.g. for a sync-worker
+# gunicorn); under the shipped `-k gevent` unit gunicorn still patches.
+if os.getenv("GEVENT_PATCH", "1") == "1":
+    try:
+        from gevent import monkey
+        monkey.patch_all()
+    except ImportError:
+        pass
+
+from flask import Flask, request, render_template, jsonify, make_response
+from functools import wraps
+import hashlib
+import re
+import selectors
 import json
 import sqlite3
-from datetime import datetime
 import psutil
 import requests
 import time
 import shutil
 import subprocess
+import threading
 from typing import Any, Dict, Optional
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_json_loads = orjson.loads if orjson else json.loads
+
+def _json_dumps(obj: Any) -> bytes:
+    if orjson:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode()
 
 app = Flask(__name__)
 
+if orjson:
+    from flask.json.provider import DefaultJSONProvider
+
+    class _OrjsonProvider(DefaultJSONProvider):
+        """Route jsonify() through orjson instead of the stdlib encoder."""
+        def dumps(self, obj: Any, **kwargs: Any) -> str:
+            return orjson.dumps(obj, default=self.default).decode()
+
+        def loads(self, s: str | bytes, **kwargs: Any) -> Any:
+            return orjson.loads(s)
+
+    app.json = _OrjsonProvider(app)
+
 # === Configuration ===
 DB_PATH = os.getenv("DB_PATH", "/etc/x-ui/x-ui.db")
 REQUEST_TIMEOUT = 5  # seconds for external HTTP calls
+LOCATION_TTL = 3600  # seconds to reuse the ip-api.com lookup
+NET_SAMPLE_INTERVAL = 1.0  # seconds between /net-live counter snapshots
+STATUS_TTL = 0.5  # seconds to reuse a /server-status reading
+NETHOGS_TIMEOUT = 10  # seconds before a /net-connections nethogs run is stopped
+NETHOGS_KILL_GRACE = 1  # seconds between SIGTERM and SIGKILL for an overrunning nethogs
+STATUS_MAX_AGE = 1  # Cache-Control max-age for the polled /server-status and /net-live
+STATIC_MAX_AGE = 3600  # Cache-Control max-age for /server-location and /cloud-provider
 
 # === Utilities ===
+_UNITS = ("Bytes", "KB", "MB", "GB", "TB")
+_UNIT_DIVISORS = tuple(float(1 << (10 * i)) for i in range(len(_UNITS)))
+
 def convert_bytes(byte_size: Optional[int | float | str]) -> str:
     """Convert byte counts to human-friendly units."""
     if byte_size in (None, "", "Not Available"):
         return "0 Bytes"
     try:
         b = float(byte_size)
-    except Exception:
+        # Unit index is floor(log1024(b)); bit_length gives it without a loop.
+        idx = min((int(b).bit_length() - 1) // 10, len(_UNITS) - 1) if b >= 1024 else 0
+    except (TypeError, ValueError, OverflowError):
         return "0 Bytes"
-    units = ["Bytes", "KB", "MB", "GB", "TB"]
-    step = 1024.0
-    idx = 0
-    while b >= step and idx < len(units) - 1:
-        b /= step
-        idx += 1
-    return f"{round(b, 2)} {units[idx]}"
+    return f"{round(b / _UNIT_DIVISORS[idx], 2)} {_UNITS[idx]}"
+
+_MS_THRESHOLD = 9_999_999_999  # epochs above this are milliseconds
+
+# The rank column makes an email match win over an id match; each arm is an
+# index/rowid search. Kept as a constant so sqlite3's statement cache reuses
+# the compiled plan.
+_USAGE_SQL = (
+    "SELECT ct.email, ct.up, ct.down, ct.total, ct.expiry_time, ct.inbound_id, ib.settings FROM ("
+    "SELECT 0 AS r, email, up, down, total, expiry_time, inbound_id FROM client_traffics WHERE email = ? "
+    "UNION ALL "
+    "SELECT 1 AS r, email, up, down, total, expiry_time, inbound_id FROM client_traffics WHERE id = ?"
+    ") AS ct LEFT JOIN inbounds ib ON ib.id = ct.inbound_id ORDER BY ct.r LIMIT 1"
+)
+
+_INDEXES_READY = False
+
+def _has_email_index(conn: sqlite3.Connection) -> bool:
+    """True if some index on client_traffics leads with email (x-ui's UNIQUE does)."""
+    for idx in conn.execute("PRAGMA index_list(client_traffics)").fetchall():
+        cols = conn.execute(f'PRAGMA index_info("{idx["name"]}")').fetchall()
+        if cols and cols[0]["name"] == "email":
+            return True
+    return False
+
+def _ensure_indexes(conn: sqlite3.Connection) -> None:
+    """Create the /usage email index once per process, only if x-ui lacks one (best-effort)."""
+    global _INDEXES_READY
+    if _INDEXES_READY:
+        return
+    try:
+        if not _has_email_index(conn):
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_ct_email ON client_traffics(email)")
+    except sqlite3.Error as e:
+        # Read-only or locked DB: lookups still work, just without the index.
+        app.logger.warning("could not create client_traffics index: %s", e)
+    _INDEXES_READY = True
+
+def _thread_local_cls() -> type:
+    """threading.local as it was before gevent patching, whoever patched it."""
+    try:
+        from gevent import monkey
+    except ImportError:
+        return threading.local
+    if monkey.is_module_patched("threading"):
+        return monkey.get_original("threading", "local")
+    return threading.local
+
+# One connection per OS thread. Under gevent threading.local is per-greenlet,
+# so use the unpatched class to keep a single connection per worker.
+_CONN = _thread_local_cls()()
 
 def open_db(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+    """Return this thread's cached read-only connection, opening it on first use.
+
+    Reopens when the file at db_path is replaced (x-ui import/restore renames a
+    new DB over the old one), so reads never stick to the unlinked inode.
+    """
+    st = os.stat(db_path)
+    ident = (db_path, st.st_dev, st.st_ino)
+    conn = getattr(_CONN, "conn", None)
+    if conn is not None:
+        if _CONN.ident == ident:
+            return conn
+        conn.close()
+        _CONN.conn = None
+    conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
     conn.row_factory = sqlite3.Row
+    _ensure_indexes(conn)  # must run before query_only is switched on
+    conn.execute("PRAGMA query_only=1")
+    _CONN.conn, _CONN.ident = conn, ident
     return conn
 
 def parse_expiry(ms_or_s: Optional[int | float]) -> str:
@@ -49,22 +161,49 @@ def parse_expiry(ms_or_s: Optional[int | float]) -> str:
         return "Invalid Date"
     try:
         ts = float(ms_or_s)
-        # Heuristic: > 9999999999 implies milliseconds
-        if ts > 9_999_999_999:
+        if ts > _MS_THRESHOLD:
             ts = ts / 1000.0
-        return datetime.utcfromtimestamp(ts).strftime("%Y-%m-%d %H:%M:%S")
-    except Exception:
+        tm = time.gmtime(ts)
+    except (TypeError, ValueError, OverflowError, OSError):
         return "Invalid Date"
+    if not 1 <= tm.tm_year <= 9999:  # outside datetime's range, which the old formatter enforced
+        return "Invalid Date"
+    return (
+        f"{tm.tm_year}-{tm.tm_mon:02d}-{tm.tm_mday:02d} "
+        f"{tm.tm_hour:02d}:{tm.tm_min:02d}:{tm.tm_sec:02d}"
+    )
 
-def _bytes_to_mbps(delta_bytes: float, seconds: float) -> float:
-    if seconds <= 0:
+def _kb_to_mbps(s: str) -> float:
+    try:
+        return round(float(s) * 8e-3, 3)
+    except ValueError:
         return 0.0
-    return round((delta_bytes * 8.0) / (seconds * 1_000_000.0), 3)
+
+# nethogs -t row (approx): iface pid user process(with-spaces...) sent_KBs recv_KBs
+_NETHOGS_RE = re.compile(r"^(\S+)\s+(\S+)\s+(\S+)\s+(.+?)\s+(\S+)\s+(\S+)$")
+
+def _cached_json(payload: Any, max_age: int):
+    """JSON response with Cache-Control and an ETag; 304 when If-None-Match matches."""
+    body = _json_dumps(payload)
+    resp = make_response(body)
+    resp.headers["Content-Type"] = "application/json"
+    resp.headers["Cache-Control"] = f"public, max-age={max_age}"
+    resp.set_etag(hashlib.blake2b(body, digest_size=8).hexdigest())
+    return resp.make_conditional(request)
+
+def _no_store(view):
+    """Mark every response of a per-user view as uncacheable."""
+    @wraps(view)
+    def wrapper(*args: Any, **kwargs: Any):
+        resp = make_response(view(*args, **kwargs))
+        resp.headers["Cache-Control"] = "no-store"
+        return resp
+    return wrapper
 
 def _safe_json_loads(s: str) -> Dict[str, Any]:
     try:
-        return json.loads(s or "{}")
-    except json.JSONDecodeError:
+        return _json_loads(s) if s else {}
+    except ValueError:  # json.JSONDecodeError and orjson.JSONDecodeError
         return {}
 
 # === Routes ===
@@ -77,10 +216,11 @@ def home():
         return jsonify({"ok": True, "message": "Traffic-X API is running. Add templates/index.html for UI."})
 
 @app.route("/usage", methods=["POST"])
+@_no_store
 def usage():
     """
-    Lookup a user by email or id in x-ui's client_traffics,
-    and cross-reference inbound settings to fetch totalGB and enable flag.
+    Lookup a user by email or id in x-ui's client_traffics, joined with
+    its inbound's settings to fetch totalGB and enable flag.
     """
     user_input = request.form.get("user_input", "").strip()
     if not user_input:
@@ -90,36 +230,30 @@ def usage():
         return jsonify({"error": f"Database not found at {DB_PATH}"}), 500
 
     try:
-        with open_db(DB_PATH) as conn:
-            cur = conn.cursor()
-            query = (
-                "SELECT email, up, down, total, expiry_time, inbound_id "
-                "FROM client_traffics WHERE email = ? OR id = ?"
-            )
-            cur.execute(query, (user_input, user_input))
-            row = cur.fetchone()
-            if not row:
-                # --- THIS IS THE MODIFIED LINE ---
-                return render_template("not_found.html"), 404
-
-            email = row["email"]
-            up = convert_bytes(row["up"])
-            down = convert_bytes(row["down"])
-            total = convert_bytes(row["total"])
-            expiry_date = parse_expiry(row["expiry_time"])
-
-            totalGB = "Not Available"
-            user_status = "Disabled"
-
-            cur.execute("SELECT settings FROM inbounds WHERE id = ?", (row["inbound_id"],))
-            inbound_row = cur.fetchone()
-            if inbound_row:
-                inbound_data = _safe_json_loads(inbound_row["settings"])
-                for client in inbound_data.get("clients", []):
-                    if client.get("email") == email:
-                        totalGB = convert_bytes(client.get("totalGB", "Not Available"))
-                        user_status = "Enabled" if client.get("enable", True) else "Disabled"
-                        break
+        conn = open_db(DB_PATH)
+        cur = conn.cursor()
+        cur.execute(_USAGE_SQL, (user_input, user_input))
+        row = cur.fetchone()
+        if not row:
+            # --- THIS IS THE MODIFIED LINE ---
+            return render_template("not_found.html"), 404
+
+        email = row["email"]
+        up = convert_bytes(row["up"])
+        down = convert_bytes(row["down"])
+        total = convert_bytes(row["total"])
+        expiry_date = parse_expiry(row["expiry_time"])
+
+        totalGB = "Not Available"
+        user_status = "Disabled"
+
+        # settings is NULL when the inbound row is missing (LEFT JOIN)
+        inbound_data = _safe_json_loads(row["settings"])
+        for client in inbound_data.get("clients", []):
+            if client.get("email") == email:
+                totalGB = convert_bytes(client.get("totalGB", "Not Available"))
+                user_status = "Enabled" if client.get("enable", True) else "Disabled"
+                break
 
         # Expecting templates/result.html (Jinja)
         try:
@@ -161,65 +295,148 @@ def update_status():
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+# Prime psutil's CPU counter so interval=None returns usage since the last call.
+psutil.cpu_percent(interval=None)
+_LAST_STATUS: Dict[str, Any] = {"ts": 0.0, "data": None}
+
 @app.route("/server-status")
 def server_status():
     """CPU, RAM, Disk %, and cumulative network counters since boot."""
+    now = time.monotonic()
+    if _LAST_STATUS["data"] is not None and now - _LAST_STATUS["ts"] < STATUS_TTL:
+        return _cached_json(_LAST_STATUS["data"], STATUS_MAX_AGE)
     try:
         net_io = psutil.net_io_counters()
         status = {
-            "cpu": psutil.cpu_percent(interval=1),
+            "cpu": psutil.cpu_percent(interval=None),
             "ram": psutil.virtual_memory().percent,
             "disk": psutil.disk_usage("/").percent,
             "net_sent": convert_bytes(net_io.bytes_sent),
             "net_recv": convert_bytes(net_io.bytes_recv),
         }
-        return jsonify(status)
+        _LAST_STATUS["ts"], _LAST_STATUS["data"] = now, status
+        return _cached_json(status, STATUS_MAX_AGE)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+_LOC_CACHE: Dict[str, Any] = {"ts": 0.0, "data": None}
+_LOC_LOCK = threading.Lock()
+
+def _cached_location() -> Optional[Dict[str, str]]:
+    if _LOC_CACHE["data"] is not None and time.monotonic() - _LOC_CACHE["ts"] < LOCATION_TTL:
+        return _LOC_CACHE["data"]
+    return None
+
 @app.route("/server-location")
 def server_location():
-    """Geo/IP using ip-api.com (no key, best-effort)."""
+    """Geo/IP using ip-api.com (no key, best-effort), cached for LOCATION_TTL."""
+    cached = _cached_location()
+    if cached is not None:
+        return _cached_json(cached, STATIC_MAX_AGE)
     try:
-        r = requests.get("http://ip-api.com/json/", timeout=REQUEST_TIMEOUT)
-        data = r.json() if r.ok else {}
-        return jsonify(
-            {
+        # Only one thread refetches on expiry; the rest reuse its result.
+        with _LOC_LOCK:
+            cached = _cached_location()
+            if cached is not None:
+                return _cached_json(cached, STATIC_MAX_AGE)
+            r = requests.get("http://ip-api.com/json/", timeout=REQUEST_TIMEOUT)
+            data = r.json() if r.ok else {}
+            loc = {
                 "country": data.get("country", "Unknown"),
                 "city": data.get("city", "Unknown"),
                 "ip": data.get("query", "Unknown"),
             }
-        )
+            if not r.ok:
+                return jsonify(loc)
+            _LOC_CACHE["ts"], _LOC_CACHE["data"] = time.monotonic(), loc
+        return _cached_json(loc, STATIC_MAX_AGE)
     except Exception as e:
+        if _LOC_CACHE["data"] is not None:
+            return _cached_json(_LOC_CACHE["data"], STATIC_MAX_AGE)  # stale beats an error
         return jsonify({"error": str(e)}), 500
 
+# (substring of DMI sys_vendor, provider) checked in order
+_SIGS = (
+    ("amazon", "AWS"),
+    ("digital", "DigitalOcean"),
+    ("linode", "Linode"),
+    ("google", "Google Cloud"),
+    ("microsoft", "Azure"),
+    ("azure", "Azure"),
+)
+
+def _detect_cloud_provider() -> str:
+    """Infer cloud provider from DMI sys_vendor (fixed after boot)."""
+    try:
+        with open("/sys/class/dmi/id/sys_vendor", "r", encoding="utf-8", errors="ignore") as f:
+            vendor = f.read().strip().lower()
+    except OSError:
+        return "Unknown"
+    return next((name for sig, name in _SIGS if sig in vendor), "Unknown")
+
+CLOUD_PROVIDER = _detect_cloud_provider()
+
 @app.route("/cloud-provider")
 def cloud_provider():
-    """Try to infer cloud provider from DMI sys_vendor."""
-    try:
-        provider = "Unknown"
-        path = "/sys/class/dmi/id/sys_vendor"
-        if os.path.exists(path):
-            with open(path, "r", encoding="utf-8", errors="ignore") as f:
-                vendor = f.read().strip().lower()
-            if "amazon" in vendor:
-                provider = "AWS"
-            elif "digital" in vendor:
-                provider = "DigitalOcean"
-            elif "linode" in vendor:
-                provider = "Linode"
-            elif "google" in vendor:
-                provider = "Google Cloud"
-            elif "microsoft" in vendor or "azure" in vendor:
-                provider = "Azure"
-        return jsonify({"provider": provider})
-    except Exception as e:
-        return jsonify({"error": str(e)}), 500
+    """Cloud provider detected from DMI sys_vendor at startup."""
+    return _cached_json({"provider": CLOUD_PROVIDER}, STATIC_MAX_AGE)
+
+_NET_LIVE_SNAPSHOT: Dict[str, Any] = {}
+_NET_LOCK = threading.Lock()
+_NET_READY = threading.Event()
+_SAMPLER_STARTED = threading.Event()
+_SAMPLER_START_LOCK = threading.Lock()
+
+def _net_sampler() -> None:
+    """Background loop: keep the latest per-interval network rates in _NET_LIVE_SNAPSHOT."""
+    global _NET_LIVE_SNAPSHOT
+    t0 = time.monotonic()
+    c0_total = psutil.net_io_counters()
+    c0_per = psutil.net_io_counters(pernic=True)
+    while True:
+        time.sleep(NET_SAMPLE_INTERVAL)
+        try:
+            t1 = time.monotonic()
+            c1_total = psutil.net_io_counters()
+            c1_per = psutil.net_io_counters(pernic=True)
+            dt = t1 - t0
+            # bytes -> Mbps factor; values are left unrounded (the UI formats them)
+            inv_dt = 8e-6 / dt if dt > 0 else 0.0
+
+            total = {
+                "rx_mbps": (c1_total.bytes_recv - c0_total.bytes_recv) * inv_dt,
+                "tx_mbps": (c1_total.bytes_sent - c0_total.bytes_sent) * inv_dt,
+            }
+
+            per_nic: Dict[str, Dict[str, float]] = {}
+            for nic, s0 in c0_per.items():
+                s1 = c1_per.get(nic)
+                if not s1:
+                    continue
+                per_nic[nic] = {
+                    "rx_mbps": (s1.bytes_recv - s0.bytes_recv) * inv_dt,
+                    "tx_mbps": (s1.bytes_sent - s0.bytes_sent) * inv_dt,
+                }
+
+            with _NET_LOCK:
+                _NET_LIVE_SNAPSHOT = {"total": total, "per_nic": per_nic}
+            _NET_READY.set()
+            t0, c0_total, c0_per = t1, c1_total, c1_per
+        except Exception:
+            app.logger.exception("net-live sampler iteration failed")
+
+def start_net_sampler() -> None:
+    """Start the /net-live sampler thread once per worker process."""
+    with _SAMPLER_START_LOCK:
+        if _SAMPLER_STARTED.is_set():
+            return
+        threading.Thread(target=_net_sampler, name="net-live-sampler", daemon=True).start()
+        _SAMPLER_STARTED.set()
 
 @app.route("/net-live")
 def net_live():
     """
-    Live network rates (Mbps) sampled over ~1s.
+    Live network rates (Mbps) over the sampler's latest ~1s window.
     Returns:
     {
       "total": {"rx_mbps": float, "tx_mbps": float},
@@ -227,34 +444,38 @@ def net_live():
     }
     """
     try:
-        t0 = time.time()
-        c0_total = psutil.net_io_counters()
-        c0_per = psutil.net_io_counters(pernic=True)
-        time.sleep(1.0)
-        t1 = time.time()
-        c1_total = psutil.net_io_counters()
-        c1_per = psutil.net_io_counters(pernic=True)
-        dt = t1 - t0
-
-        total = {
-            "rx_mbps": _bytes_to_mbps(c1_total.bytes_recv - c0_total.bytes_recv, dt),
-            "tx_mbps": _bytes_to_mbps(c1_total.bytes_sent - c0_total.bytes_sent, dt),
-        }
-
-        per_nic: Dict[str, Dict[str, float]] = {}
-        for nic, s0 in c0_per.items():
-            s1 = c1_per.get(nic)
-            if not s1:
-                continue
-            per_nic[nic] = {
-                "rx_mbps": _bytes_to_mbps(s1.bytes_recv - s0.bytes_recv, dt),
-                "tx_mbps": _bytes_to_mbps(s1.bytes_sent - s0.bytes_sent, dt),
-            }
-
-        return jsonify({"total": total, "per_nic": per_nic})
+        # Started lazily so each gunicorn worker runs its own thread after fork.
+        if not _SAMPLER_STARTED.is_set():
+            start_net_sampler()
+        if not _NET_READY.wait(timeout=NET_SAMPLE_INTERVAL * 2):
+            return jsonify({"error": "network sampler not ready"}), 503
+        with _NET_LOCK:
+            snapshot = _NET_LIVE_SNAPSHOT
+        return _cached_json(snapshot, STATUS_MAX_AGE)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
+def _parse_nethogs_line(raw: str, rows: list, output: list) -> None:
+    """Record a nethogs output line, appending it to rows if it is a traffic row."""
+    line = raw.strip()
+    if not line:
+        return
+    output.append(line)
+    m = _NETHOGS_RE.match(line) if not line.startswith("Refreshing:") else None
+    if not m:
+        return
+    iface, pid, user, process, sent_kbs, recv_kbs = m.groups()
+    rows.append(
+        {
+            "iface": iface,
+            "pid": pid,
+            "user": user,
+            "process": process,
+            "tx_mbps": _kb_to_mbps(sent_kbs),
+            "rx_mbps": _kb_to_mbps(recv_kbs),
+        }
+    )
+
 @app.route("/net-connections")
 def net_connections():
     """
@@ -274,48 +495,69 @@ def net_connections():
             return jsonify({"available": False, "message": "nethogs not installed"}), 200
 
         # -t text mode, -c 1 one iteration, -d 1 delay=1s
-        out = subprocess.check_output(
+        # Lines are parsed as nethogs emits them; under gevent the selects yield.
+        proc = subprocess.Popen(
             ["sudo", "nethogs", "-t", "-c", "1", "-d", "1"],
+            stdout=subprocess.PIPE,
             stderr=subprocess.STDOUT,
-            text=True,
-            timeout=10,
+            bufsize=0,
         )
 
+        def _stop() -> None:
+            proc.terminate()  # SIGTERM, which sudo forwards to nethogs
+            try:
+                proc.wait(timeout=NETHOGS_KILL_GRACE)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+
+        deadline = time.monotonic() + NETHOGS_TIMEOUT
+        timed_out = False
         rows = []
-        for raw in out.splitlines():
-            line = raw.strip()
-            if not line or line.startswith("Refreshing:"):
-                continue
-            parts = line.split()
-            # Expected (approx): iface pid user process(with-spaces...) sent_KBs recv_KBs
-            if len(parts) < 6:
-                continue
-            iface, pid, user = parts[0], parts[1], parts[2]
-            sent_kbs, recv_kbs = parts[-2], parts[-1]
-            process = " ".join(parts[3:-2])
-
-            def kb_to_mbps(s: str) -> float:
+        output = []  # every non-empty line, reported in full if nethogs fails
+        pending = b""
+        sel = selectors.DefaultSelector()
+        try:
+            fd = proc.stdout.fileno()
+            sel.register(fd, selectors.EVENT_READ)
+            # Reads are bounded by the deadline, so a child that ignores SIGTERM
+            # or a grandchild holding the pipe open cannot stall the request.
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    timed_out = True
+                    break
+                if not sel.select(remaining):
+                    continue
+                chunk = os.read(fd, 65536)
+                if not chunk:
+                    break
+                *lines, pending = (pending + chunk).split(b"\n")
+                for raw in lines:
+                    _parse_nethogs_line(raw.decode("utf-8"), rows, output)
+            if not timed_out:
+                if pending:
+                    _parse_nethogs_line(pending.decode("utf-8"), rows, output)
                 try:
-                    return round((float(s) * 8.0) / 1000.0, 3)
-                except Exception:
-                    return 0.0
-
-            rows.append(
-                {
-                    "iface": iface,
-                    "pid": pid,
-                    "user": user,
-                    "process": process,
-                    "tx_mbps": kb_to_mbps(sent_kbs),
-                    "rx_mbps": kb_to_mbps(recv_kbs),
-                }
-            )
-
+                    rc = proc.wait(timeout=max(deadline - time.monotonic(), 0.1))
+                except subprocess.TimeoutExpired:
+                    timed_out = True
+            if timed_out:
+                _stop()
+        except Exception:
+            # e.g. UnicodeDecodeError mid-read: don't leave sudo nethogs running
+            proc.kill()
+            proc.wait()
+            raise
+        finally:
+            sel.close()
+            proc.stdout.close()
+
+        if timed_out:
+            return jsonify({"available": False, "message": "nethogs timed out"}), 200
+        if rc != 0:
+            return jsonify({"available": False, "message": "\n".join(output)}), 200
         return jsonify({"available": True, "rows": rows})
-    except subprocess.CalledProcessError as e:
-        return jsonify({"available": False, "message": e.output}), 200
-    except subprocess.TimeoutExpired:
-        return jsonify({"available": False, "message": "nethogs timed out"}), 200
     except Exception as e:
         return jsonify({"available": False, "message": str(e)}), 200
 